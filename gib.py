@@ -2,49 +2,52 @@
 
 import os
 import stat
+import time
 from argparse import ArgumentParser
-from collections.abc import MutableMapping
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import magic
 import pygit2 as git
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    Template,
+    select_autoescape,
+)
+from markupsafe import Markup
 
 
 MAX_COMMITS = 100
 MAX_REFS = 100
 MAX_FILES = 100
-
-
-def is_mime_viewable(mime):
-    if mime.startswith("text/"):
-        return True
-    elif mime in [
+COMMIT_BATCH_SIZE = 100
+MIME_SNIFF_BYTES = 4096
+VIEWABLE_MIMES = frozenset(
+    {
         "application/json",
-    ]:
-        return True
-    return False
+    }
+)
 
 
-# https://stackoverflow.com/questions/6027558/
-def flatten(dictionary, parent_key="", separator="/"):
-    items = []
-    for key, value in dictionary.items():
-        new_key = parent_key + separator + key if parent_key else key
-        if isinstance(value, MutableMapping):
-            items.extend(flatten(value, new_key, separator=separator).items())
-        else:
-            items.append((new_key, value))
-    return dict(items)
+def is_mime_viewable(mime):
+    return mime.startswith("text/") or mime in VIEWABLE_MIMES
 
 
 def format_time(timestamp):
-    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+    t = time.gmtime(timestamp)
+    return "%04d-%02d-%02d %02d:%02d" % (
+        t.tm_year,
+        t.tm_mon,
+        t.tm_mday,
+        t.tm_hour,
+        t.tm_min,
+    )
 
 
 def get_commit_message(commit: git.Commit):
-    return commit.message.split("\n")[0].strip()
+    return commit.message.partition("\n")[0].strip()
 
 
 def get_branch_name(ref: git.Branch):
@@ -52,28 +55,53 @@ def get_branch_name(ref: git.Branch):
 
 
 def get_commits(repo: git.Repository, oid: git.Oid = None):
+    # newest first, by commit time; commits sharing a commit time come out
+    # children before parents
     if oid != None:
-        walker = repo.walk(oid, git.GIT_SORT_TOPOLOGICAL)
+        walker = repo.walk(oid, git.GIT_SORT_TIME)
     else:
-        walker = repo.walk(repo.head.target, git.GIT_SORT_TOPOLOGICAL)
+        walker = repo.walk(repo.head.target, git.GIT_SORT_TIME)
     return [commit for commit in walker]
 
 
-def list_files(repo: git.Repository, tree: git.Tree = None):
-    files = {}
+def iter_files(tree: git.Tree, prefix=()):
+    stack = [(prefix, tree)]
+    while stack:
+        parent_components, tree = stack.pop()
+        for e in tree:
+            components = parent_components + (e.name,)
+            if isinstance(e, git.Tree):
+                stack.append((components, e))
+            else:
+                yield components, e
+
+
+def get_tree(repo: git.Repository, oid: git.Oid, trees):
+    tree = trees.get(oid)
     if tree == None:
-        tree = repo.get(repo.head.target).tree
-    for e in tree:
-        if isinstance(e, git.Tree):
-            files[e.name] = list_files(repo, e)
-        else:
-            files[e.name] = e
-    return files
+        tree = trees.setdefault(oid, repo.get(oid))
+    return tree
+
+
+def get_commit_diff(
+    repo: git.Repository,
+    commit: git.Commit,
+    parent: git.Commit,
+    trees,
+):
+    # a commit's tree is usually its child's parent tree, so share them
+    tree = get_tree(repo, commit.tree_id, trees)
+    if parent != None:
+        parent_tree = get_tree(repo, parent.tree_id, trees)
+        return tree.diff_to_tree(parent_tree, swap=True)
+    return tree.diff_to_tree(swap=True)
 
 
-def get_tags(repo: git.Repository):
+def get_tags(repo: git.Repository, limit=None):
     tags = []
     for ref_name in repo.references:
+        if limit != None and len(tags) >= limit:
+            break
         if not ref_name.startswith("refs/tags/"):
             continue
         ref = repo.references[ref_name]
@@ -86,19 +114,51 @@ def get_tags(repo: git.Repository):
     return tags
 
 
-def get_branches(repo: git.Repository):
+def get_branches(repo: git.Repository, limit=None):
     branches = []
-    for branch_name in list(repo.branches.remote):
-        branch = repo.branches.remote[branch_name]
-        if not isinstance(branch, git.Branch):
-            continue
-        if not isinstance(branch.target, git.Oid):
+    remote_branches = repo.branches.remote
+    for branch_name in remote_branches:
+        if limit != None and len(branches) >= limit:
+            break
+        branch = remote_branches[branch_name]
+        if not isinstance(branch.target, git.Oid):  # symbolic, e.g. origin/HEAD
             continue
         commit = repo.get(branch.target)
         branches.append((branch, commit))
     return branches
 
 
+def generate_commit_html(
+    repo: git.Repository,
+    tpl: Template,
+    metadata,
+    commit_outdir,
+    commit: git.Commit,
+    parent: git.Commit,
+    next_commit: git.Commit,
+    trees,
+):
+    parent_diff = get_commit_diff(repo, commit, parent, trees)
+    stats = parent_diff.stats
+    render = tpl.render(
+        title=f"{commit.id} - {metadata['name']}",
+        metadata=metadata,
+        commit_author_name=commit.author.name,
+        commit_author_email=commit.author.email,
+        commit_time=format_time(commit.commit_time),
+        commit_message=get_commit_message(commit),
+        commit_insertions=stats.insertions,
+        commit_deletions=stats.deletions,
+        parent_commit_id=parent.id if parent else None,
+        parent_commit_message=get_commit_message(parent) if parent else None,
+        next_commit_id=next_commit.id if next_commit else None,
+        next_commit_message=get_commit_message(next_commit) if next_commit else None,
+        content=parent_diff.patch,
+    )
+    Path(f"{commit_outdir}{commit.id}.html").write_text(render + "\n")
+    return stats
+
+
 def generate_commits_html(
     repo: git.Repository,
     template_env: Environment,
@@ -106,54 +166,41 @@ def generate_commits_html(
     outdir,
 ):
     commits = get_commits(repo)
-    commits.sort(key=lambda commit: commit.commit_time)
-    commits.reverse()
+    # the walk already loaded every ancestor, so parents come from here
+    # instead of commit.parents, which reads them from the odb again
+    commits_by_id = {commit.id: commit for commit in commits}
+    parents = [
+        commits_by_id[commit.parent_ids[0]] if len(commit.parent_ids) > 0 else None
+        for commit in commits
+    ]
     data = []
     tpl = template_env.get_template("commit.html")
-    os.makedirs(os.path.join(outdir, "commit"), exist_ok=True)
-    for i in range(len(commits)):
-        commit = commits[i]
-        next_commit_id = None
-        next_commit_message = None
-        parent = None
-        if i > 0:
-            next_commit_id = commits[i - 1].id
-            next_commit_message = get_commit_message(commits[i - 1])
-        if len(commit.parents) > 0:
-            parent = commit.parents[0]
-            parent_diff = commit.tree.diff_to_tree(parent.tree, swap=True)
-        else:
-            parent_diff = commit.tree.diff_to_tree(swap=True)
-        stats = parent_diff.stats
-        if i < MAX_COMMITS:
-            data.append(
-                {
-                    "commit_author_name": commit.author.name,
-                    "commit_author_email": commit.author.email,
-                    "commit_time": format_time(commit.commit_time),
-                    "commit_id": commit.id,
-                    "commit_message": get_commit_message(commit),
-                    "commit_insertions": stats.insertions,
-                    "commit_deletions": stats.deletions,
-                }
-            )
-        render = tpl.render(
-            title=f"{commit.id} - {metadata['name']}",
-            metadata=metadata,
-            commit_author_name=commit.author.name,
-            commit_author_email=commit.author.email,
-            commit_time=format_time(commit.commit_time),
-            commit_message=get_commit_message(commit),
-            commit_insertions=stats.insertions,
-            commit_deletions=stats.deletions,
-            parent_commit_id=parent.id if parent else None,
-            parent_commit_message=get_commit_message(parent) if parent else None,
-            next_commit_id=next_commit_id,
-            next_commit_message=next_commit_message,
-            content=parent_diff.patch,
+    commit_outdir = os.path.join(outdir, "commit") + os.sep
+    os.makedirs(commit_outdir, exist_ok=True)
+
+    def generate(i, trees):
+        return generate_commit_html(
+            repo,
+            tpl,
+            metadata,
+            commit_outdir,
+            commits[i],
+            parents[i],
+            commits[i - 1] if i > 0 else None,
+            trees,
         )
-        with open(os.path.join(outdir, "commit", f"{commit.id}.html"), "w") as f:
-            print(render, file=f)
+
+    # each worker diffs, renders and writes one page, so only the stats
+    # outlive it. pages go in batches of neighbouring commits that share
+    # one tree cache, so the cache never holds more than a batch's trees
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        for batch in range(0, len(commits), COMMIT_BATCH_SIZE):
+            indices = range(batch, min(batch + COMMIT_BATCH_SIZE, len(commits)))
+            trees = {}
+            batch_stats = ex.map(generate, indices, [trees] * len(indices))
+            for i, stats in zip(indices, batch_stats):
+                if i < MAX_COMMITS:
+                    data.append((commits[i], stats))
 
     tpl = template_env.get_template("commits.html")
     render = tpl.render(
@@ -162,8 +209,7 @@ def generate_commits_html(
         commits=data,
         n_commits=len(commits),
     )
-    with open(os.path.join(outdir, "commits.html"), "w") as f:
-        print(render, file=f)
+    Path(os.path.join(outdir, "commits.html")).write_text(render + "\n")
 
 
 def generate_refs_html(
@@ -172,10 +218,10 @@ def generate_refs_html(
     metadata,
     outdir,
 ):
-    raw_data = [get_branches(repo), get_tags(repo)]
+    raw_data = [get_branches(repo, MAX_REFS), get_tags(repo, MAX_REFS)]
     data = []
     for i in range(len(raw_data)):
-        tmp = raw_data[i][:MAX_REFS]
+        tmp = raw_data[i]
         tmp.sort(key=lambda x: x[1].commit_time)
         tmp.reverse()
         data.append(
@@ -197,8 +243,26 @@ def generate_refs_html(
         n_branches=len(data[0]),
         n_tags=len(data[1]),
     )
-    with open(os.path.join(outdir, "refs.html"), "w") as f:
-        print(render, file=f)
+    Path(os.path.join(outdir, "refs.html")).write_text(render + "\n")
+
+
+def generate_file_html(
+    tpl: Template,
+    metadata,
+    out_path,
+    title,
+    file_path,
+    file_mode,
+    content,
+):
+    render = tpl.render(
+        title=title,
+        metadata=metadata,
+        file_mode=file_mode,
+        file_path=file_path,
+        content=content,
+    )
+    Path(out_path).write_text(render + "\n")
 
 
 def generate_files_html(
@@ -208,38 +272,68 @@ def generate_files_html(
     outdir,
     tree: git.Tree = None,
 ):
-    raw_data = [(k, v) for k, v in flatten(list_files(repo, tree)).items()]
-    raw_data.sort(key=lambda x: x[0])
+    if tree == None:
+        tree = repo.head.peel(git.Tree)
+    raw_data = sorted(
+        (
+            ("/".join(components), components, file)
+            for components, file in iter_files(tree)
+        ),
+        key=lambda x: x[0],
+    )
     data = []
     tpl = template_env.get_template("file.html")
-    for i in range(len(raw_data)):
-        file_path, file = raw_data[i]
-        file_mode = stat.filemode(file.filemode)[1:]
-        mime = magic.from_buffer(file.data, mime=True)
-        if i < MAX_FILES:
-            data.append(
-                {
-                    "mode": file_mode,
-                    "path": file_path,
-                    "viewable": is_mime_viewable(mime),
-                }
-            )
-        if is_mime_viewable(mime):
-            render = tpl.render(
-                title=f"{file_path} - {metadata['name']}",
-                metadata=metadata,
-                file_mode=file_mode,
-                file_path=file_path,
-                content=file.data.decode("utf-8"),
-            )
-            out_path = os.path.join(
-                outdir,
-                "file",
-                *f"{file_path}.html".split("/"),
-            )
-            os.makedirs(os.path.dirname(out_path), exist_ok=True)
-            with open(out_path, "w") as f:
-                print(render, file=f)
+    title_suffix = f" - {metadata['name']}"
+    file_outdir = os.path.join(outdir, "file") + os.sep
+    file_dirs = set()
+    mime_magic = magic.Magic(mime=True)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        jobs = []
+        for i in range(len(raw_data)):
+            file_path, file_components, file = raw_data[i]
+            file_mode = stat.filemode(file.filemode)[1:]
+            file_data = memoryview(file)
+            # libgit2 already rules out binary blobs, so only sniff the rest
+            if file.is_binary:
+                viewable = False
+            else:
+                mime = mime_magic.from_buffer(bytes(file_data[:MIME_SNIFF_BYTES]))
+                viewable = is_mime_viewable(mime)
+            # the mime type only comes from a prefix, so the rest of the blob
+            # may still not be text
+            if viewable:
+                try:
+                    content = str(file_data, "utf-8")
+                except UnicodeDecodeError:
+                    viewable = False
+            if i < MAX_FILES:
+                data.append(
+                    {
+                        "mode": file_mode,
+                        "path": file_path,
+                        "viewable": viewable,
+                    }
+                )
+            if viewable:
+                out_path = file_outdir + os.sep.join(file_components) + ".html"
+                file_dir = os.path.dirname(out_path)
+                if file_dir not in file_dirs:
+                    file_dirs.add(file_dir)
+                    os.makedirs(file_dir, exist_ok=True)
+                jobs.append(
+                    ex.submit(
+                        generate_file_html,
+                        tpl,
+                        metadata,
+                        out_path,
+                        file_path + title_suffix,
+                        file_path,
+                        file_mode,
+                        content,
+                    )
+                )
+        for job in jobs:
+            job.result()
     tpl = template_env.get_template("files.html")
     render = tpl.render(
         title=f"Files - {metadata['name']}",
@@ -247,8 +341,7 @@ def generate_files_html(
         files=data,
         n_files=len(raw_data),
     )
-    with open(os.path.join(outdir, "files.html"), "w") as f:
-        print(render, file=f)
+    Path(os.path.join(outdir, "files.html")).write_text(render + "\n")
 
 
 def parse_args():
@@ -274,12 +367,22 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
+
+    # objects are read once per run, so skip libgit2's object cache and
+    # the re-hashing of every object read from the odb
+    git.option(git.GIT_OPT_ENABLE_STRICT_HASH_VERIFICATION, 0)
+    git.option(git.GIT_OPT_ENABLE_CACHING, 0)
+
     repo = git.Repository(args.repodir)
 
     template_env = Environment(
         loader=FileSystemLoader(searchpath="./templates"),
         autoescape=select_autoescape(),
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=False,
     )
+    template_env.filters["format_time"] = format_time
+    template_env.filters["commit_message"] = get_commit_message
 
     metadata = {
         "name": os.path.basename(os.path.abspath(args.repodir))
@@ -288,6 +391,14 @@ if __name__ == "__main__":
         "description": "no description provided." if not args.desc else args.desc,
     }
 
+    # the page chrome only depends on metadata, so render it once
+    template_env.globals["nav"] = Markup(
+        template_env.get_template("_nav.html").render(metadata=metadata)
+    )
+    template_env.globals["footer"] = Markup(
+        template_env.get_template("_footer.html").render()
+    )
+
     os.makedirs(args.outdir, exist_ok=True)
 
     generate_commits_html(repo, template_env, metadata, args.outdir)